@@ -1,19 +1,79 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, render_template, request, jsonify, send_file
 import os
 from werkzeug.utils import secure_filename
 from datetime import datetime
 import sys
+import logging
+import threading
+import uuid
+
+# Face matcher settings; the matcher itself is created on first use (see get_face_matcher)
+FACE_MATCHER_OPTIONS = dict(tolerance=0.45, model='cnn', min_confidence=0.55) # Use 'cnn' if you have GPU
+
+# BLAS/OpenMP thread pools are sized when numpy and dlib load, so set them before those
+# imports. Every encoding worker inherits them, so the cores are split between the
+# workers (one per CPU by default) instead of each worker starting a thread per CPU
+_cpu_count = os.cpu_count() or 1
+_blas_threads = max(1, _cpu_count // (FACE_MATCHER_OPTIONS.get('workers') or _cpu_count))
+for var in ('OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'OMP_NUM_THREADS'):
+    os.environ.setdefault(var, str(_blas_threads))
 
 # Add utils folder to path so we can import our face_matcher
 sys.path.append(os.path.join(os.path.dirname(__file__), 'utils'))
 
-from face_matcher import FaceMatcher
+import dlib
+from face_matcher import FaceMatcher, content_hasher
+
+# Libraries only log warnings; face_matcher logs at LOG_LEVEL (per-photo messages are DEBUG)
+logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logging.getLogger('face_matcher').setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# Without SIMD or CUDA every dlib convolution runs scalar, several times slower
+if not (dlib.DLIB_USE_CUDA or dlib.USE_AVX_INSTRUCTIONS or dlib.USE_NEON_INSTRUCTIONS):
+    logging.warning("dlib was built without CUDA, AVX or NEON support; face detection will be slow. "
+                    "Rebuild dlib with -DUSE_AVX_INSTRUCTIONS=ON (and -DDLIB_USE_CUDA=ON on a GPU machine).")
 
-app = Flask(__name__)
+try:
+    import orjson
+except ImportError:  # orjson is optional; responses fall back to Flask's jsonify
+    orjson = None
+
+# Uploaded photos are named after their content and never change, so browsers may keep them a year
+UPLOAD_MAX_AGE = 365 * 24 * 60 * 60
+
+class PhotoFinderApp(Flask):
+    def get_send_file_max_age(self, filename):
+        if filename and filename.replace('\\', '/').startswith('uploads/'):
+            return UPLOAD_MAX_AGE
+        return super().get_send_file_max_age(filename)
+
+app = PhotoFinderApp(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Let a front-end server (Apache mod_xsendfile, lighttpd) send static files instead of a Flask worker
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
 
-# Initialize face matcher
-face_matcher = FaceMatcher(tolerance=0.45, model='cnn', min_confidence=0.55) # Use 'cnn' if you have GPU
+_face_matcher = None
+_face_matcher_lock = threading.Lock()
+
+def get_face_matcher():
+    """
+    The app's FaceMatcher, created by the first request that needs it. Processes
+    that only import this module (spawned encoding workers re-import it as their
+    main module, the debug reloader runs it too) then never open the shared cache.
+    """
+    global _face_matcher
+    with _face_matcher_lock:
+        if _face_matcher is None:
+            _face_matcher = FaceMatcher(**FACE_MATCHER_OPTIONS)
+        return _face_matcher
+
+def warm_up():
+    """
+    Create the matcher (loading and warming up the models) before the first request,
+    so the first guest search doesn't wait for it. Call it once in every process that
+    serves requests, e.g. from a gunicorn post_worker_init hook.
+    """
+    get_face_matcher()
 
 # Create upload directories
 UPLOAD_FOLDER = 'static/uploads'
@@ -24,9 +84,19 @@ for folder in [WEDDING_PHOTOS_FOLDER, GUEST_PHOTOS_FOLDER]:
     os.makedirs(folder, exist_ok=True)
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+_ALLOWED_SUFFIXES = frozenset('.' + ext for ext in ALLOWED_EXTENSIONS)
+
+def ojson(obj, status=200):
+    """JSON response serialized with orjson when available (much faster on large match lists)."""
+    if orjson is None:
+        response = jsonify(obj)
+        response.status_code = status
+        return response
+    return Response(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY),
+                    status=status, mimetype='application/json')
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return os.path.splitext(filename)[1].lower() in _ALLOWED_SUFFIXES
 
 @app.route('/')
 def index():
@@ -35,7 +105,8 @@ def index():
 @app.route('/photographer')
 def photographer():
     # Get count of uploaded wedding photos
-    photo_count = len([f for f in os.listdir(WEDDING_PHOTOS_FOLDER) if allowed_file(f)])
+    with os.scandir(WEDDING_PHOTOS_FOLDER) as entries:
+        photo_count = sum(1 for entry in entries if entry.is_file() and allowed_file(entry.name))
     return render_template('photographer.html', photo_count=photo_count)
 
 @app.route('/guest')
@@ -45,23 +116,39 @@ def guest():
 @app.route('/upload_wedding_photos', methods=['POST'])
 def upload_wedding_photos():
     if 'photos' not in request.files:
-        return jsonify({'error': 'No photos provided'}), 400
+        return ojson({'error': 'No photos provided'}, 400)
     
     files = request.files.getlist('photos')
     uploaded_count = 0
     
     for file in files:
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            # Add timestamp to avoid duplicates
-            name, ext = os.path.splitext(filename)
-            filename = f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{ext}"
-            
-            file_path = os.path.join(WEDDING_PHOTOS_FOLDER, filename)
-            file.save(file_path)
+            name, ext = os.path.splitext(secure_filename(file.filename))
+            # Hash while writing, so re-uploads of a photo reuse its cached encodings
+            # without the file being read again. The name isn't known until the whole
+            # photo is hashed, so write it under a temporary name first (one that
+            # allowed_file skips)
+            part_path = os.path.join(WEDDING_PHOTOS_FOLDER, f'.{uuid.uuid4().hex}.part')
+            hasher = content_hasher()
+            try:
+                with open(part_path, 'wb') as out:
+                    for chunk in iter(lambda: file.stream.read(64 * 1024), b''):
+                        hasher.update(chunk)
+                        out.write(chunk)
+                digest = hasher.hexdigest()
+                # Timestamp plus content digest: two different photos with the same name
+                # never share a URL, even within the same second
+                filename = f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{digest[:12]}{ext}"
+                file_path = os.path.join(WEDDING_PHOTOS_FOLDER, filename)
+                os.replace(part_path, file_path)
+            finally:
+                # Left behind only if the upload failed part-way
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+            get_face_matcher().remember_digest(file_path, digest)
             uploaded_count += 1
     
-    return jsonify({
+    return ojson({
         'success': True, 
         'message': f'Successfully uploaded {uploaded_count} photos'
     })
@@ -73,105 +160,135 @@ def preprocess_photos():
     This can be called after photographer uploads to speed up guest searches.
     """
     try:
-        stats = face_matcher.batch_process_wedding_photos(WEDDING_PHOTOS_FOLDER, ALLOWED_EXTENSIONS)
-        return jsonify({
+        stats = get_face_matcher().batch_process_wedding_photos(WEDDING_PHOTOS_FOLDER, ALLOWED_EXTENSIONS)
+        return ojson({
             'success': True,
             'message': f'Pre-processed {stats["processed"]} photos, found {stats["total_faces_found"]} faces',
             'stats': stats
         })
     except Exception as e:
-        return jsonify({
+        return ojson({
             'success': False,
             'error': f'Error during pre-processing: {str(e)}'
-        }), 500
+        }, 500)
 
 @app.route('/find_matches', methods=['POST'])
 def find_matches():
     if 'guest_photo' not in request.files:
-        return jsonify({'error': 'No guest photo provided'}), 400
+        return ojson({'error': 'No guest photo provided'}, 400)
     
     file = request.files['guest_photo']
     if not file or not allowed_file(file.filename):
-        return jsonify({'error': 'Invalid file format'}), 400
-    
-    # Save guest photo temporarily
-    filename = secure_filename(file.filename)
-    temp_filename = f"temp_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{filename}"
-    guest_photo_path = os.path.join(GUEST_PHOTOS_FOLDER, temp_filename)
-    file.save(guest_photo_path)
+        return ojson({'error': 'Invalid file format'}, 400)
     
     try:
-        # Use the FaceMatcher to find matches
-        result = face_matcher.find_matching_photos(
-            guest_photo_path, 
+        # Decode the upload stream in memory instead of saving it to disk first
+        result = get_face_matcher().find_matching_photos(
+            file.stream, 
             WEDDING_PHOTOS_FOLDER, 
             ALLOWED_EXTENSIONS
         )
         
-        # Clean up temporary guest photo
-        if os.path.exists(guest_photo_path):
-            os.remove(guest_photo_path)
-        
         if result['success']:
-            return jsonify({
+            return ojson({
                 'success': True,
                 'matches': result['matches'],
                 'total_matches': result['total_matches'],
                 'stats': result['stats']
             })
         else:
-            return jsonify({
+            return ojson({
                 'success': False,
                 'error': result['error']
-            }), 400
+            }, 400)
         
     except Exception as e:
-        # Clean up temporary guest photo
-        if os.path.exists(guest_photo_path):
-            os.remove(guest_photo_path)
-        return jsonify({'error': f'Error processing photo: {str(e)}'}), 500
+        return ojson({'error': f'Error processing photo: {str(e)}'}, 500)
+
+@app.route('/find_matches_batch', methods=['POST'])
+def find_matches_batch():
+    """Match several guest photos in one request (e.g. from a photo booth)"""
+    files = [file for file in request.files.getlist('guest_photos') if file and file.filename]
+    if not files:
+        return ojson({'error': 'No guest photos provided'}, 400)
+    
+    if not all(allowed_file(file.filename) for file in files):
+        return ojson({'error': 'Invalid file format'}, 400)
+    
+    try:
+        results = get_face_matcher().find_matching_photos_batch(
+            [file.stream for file in files],
+            WEDDING_PHOTOS_FOLDER,
+            ALLOWED_EXTENSIONS
+        )
+    
+        response = []
+        for file, result in zip(files, results):
+            if result['success']:
+                response.append({
+                    'guest_photo': file.filename,
+                    'success': True,
+                    'matches': result['matches'],
+                    'total_matches': result['total_matches'],
+                    'stats': result['stats']
+                })
+            else:
+                response.append({
+                    'guest_photo': file.filename,
+                    'success': False,
+                    'error': result['error']
+                })
+    
+        return ojson({
+            'success': True,
+            'results': response
+        })
+    
+    except Exception as e:
+        return ojson({'error': f'Error processing photos: {str(e)}'}, 500)
 
 @app.route('/get_wedding_photos')
 def get_wedding_photos():
     """Get list of all wedding photos for photographer view"""
     photos = []
-    for filename in os.listdir(WEDDING_PHOTOS_FOLDER):
-        if allowed_file(filename):
-            photos.append({
-                'filename': filename,
-                'path': f'/static/uploads/wedding_photos/{filename}'
-            })
-    return jsonify(photos)
+    with os.scandir(WEDDING_PHOTOS_FOLDER) as entries:
+        for entry in entries:
+            if entry.is_file() and allowed_file(entry.name):
+                photos.append({
+                    'filename': entry.name,
+                    'path': f'/static/uploads/wedding_photos/{entry.name}'
+                })
+    return ojson(photos)
 
 @app.route('/get_cache_stats')
 def get_cache_stats():
     """Get face recognition cache statistics"""
     try:
-        stats = face_matcher.get_cache_stats()
-        return jsonify({
+        stats = get_face_matcher().get_cache_stats()
+        return ojson({
             'success': True,
             'cache_stats': stats
         })
     except Exception as e:
-        return jsonify({
+        return ojson({
             'success': False,
             'error': str(e)
-        }), 500
+        }, 500)
 
 @app.route('/clear_cache', methods=['POST'])
 def clear_cache():
     """Clear the face recognition cache"""
     try:
-        face_matcher.clear_cache()
-        return jsonify({
+        get_face_matcher().clear_cache()
+        return ojson({
             'success': True,
             'message': 'Face recognition cache cleared successfully'
         })
     except Exception as e:
-        return jsonify({
+        return ojson({
             'success': False,
             'error': str(e)
-        }), 500
+        }, 500)
 
 @app.route('/face_debug/<path:filename>')
 def face_debug(filename):
@@ -179,12 +296,12 @@ def face_debug(filename):
     try:
         image_path = os.path.join(WEDDING_PHOTOS_FOLDER, filename)
         if not os.path.exists(image_path):
-            return jsonify({'error': 'Image not found'}), 404
+            return ojson({'error': 'Image not found'}, 404)
         
-        faces_info = face_matcher.get_face_locations_with_confidence(image_path)
-        encodings = face_matcher.get_face_encodings(image_path)
+        faces_info = get_face_matcher().get_face_locations_with_confidence(image_path)
+        encodings = get_face_matcher().get_face_encodings(image_path)
         
-        return jsonify({
+        return ojson({
             'success': True,
             'filename': filename,
             'faces_detected': len(faces_info),
@@ -192,14 +309,20 @@ def face_debug(filename):
             'encodings_count': len(encodings)
         })
     except Exception as e:
-        return jsonify({
+        return ojson({
             'success': False,
             'error': str(e)
-        }), 500
+        }, 500)
 
 if __name__ == '__main__':
     print("Starting Wedding Photo Finder...")
-    print(f"Face matcher initialized with tolerance: {face_matcher.tolerance}")
+    print(f"Face matcher tolerance: {FACE_MATCHER_OPTIONS['tolerance']}")
     print(f"Upload folders: {WEDDING_PHOTOS_FOLDER}, {GUEST_PHOTOS_FOLDER}")
     
-    app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
+    app.debug = True
+    # The debug reloader re-runs this script in a child that serves the requests while
+    # this process only watches for changes; warm up wherever requests are served
+    if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        warm_up()
+    
+    app.run(host='0.0.0.0', port=5001)
\ No newline at end of file
@@ -0,0 +1,77 @@
+"""
+Distance reductions used by FaceMatcher searches.
+
+With numba installed these are compiled loops that make a single pass over the
+wedding faces, without the temporary arrays of the numpy versions. They run
+serially: searches are called from web server threads, and numba's parallel
+threading layers either hang at exit or abort on concurrent calls from them.
+The loops are O(faces) after the GEMV, which dominates a search anyway.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:  # numba is optional; the numpy versions below are used instead
+    numba = None
+
+
+def _closest_per_photo(dots, sqnorms, guest_sqnorm, photo_starts):
+    """
+    Distance from the guest to the closest face of every photo.
+
+    Args:
+        dots (np.ndarray): (N,) dot products of every wedding face with the guest encoding
+        sqnorms (np.ndarray): (N,) squared norms of the wedding faces
+        guest_sqnorm (float): Squared norm of the guest encoding
+        photo_starts (np.ndarray): First row of each photo; rows of one photo are contiguous
+
+    Returns:
+        np.ndarray: (len(photo_starts),) float32 distances
+    """
+    n_photos = photo_starts.shape[0]
+    best = np.empty(n_photos, dtype=np.float32)
+    for photo in range(n_photos):
+        end = photo_starts[photo + 1] if photo + 1 < n_photos else dots.shape[0]
+        closest = np.inf
+        for row in range(photo_starts[photo], end):
+            # ||m - g||^2 = ||m||^2 - 2 m.g + ||g||^2, square root taken once per photo
+            sq_dist = sqnorms[row] - 2 * dots[row] + guest_sqnorm
+            if sq_dist < closest:
+                closest = sq_dist
+        best[photo] = np.sqrt(max(closest, 0.0))
+    return best
+
+
+def _min_per_group(values, group_ids, n_groups):
+    """
+    Smallest value of every group, inf for groups without values.
+
+    Args:
+        values (np.ndarray): (K,) values, e.g. distances returned by a radius query
+        group_ids (np.ndarray): (K,) group (photo) number of every value
+        n_groups (int): Number of groups
+
+    Returns:
+        np.ndarray: (n_groups,) float32 minimums
+    """
+    best = np.full(n_groups, np.inf, dtype=np.float32)
+    for i in range(values.shape[0]):
+        group = group_ids[i]
+        if values[i] < best[group]:
+            best[group] = values[i]
+    return best
+
+
+if numba is not None:
+    closest_per_photo = numba.njit(cache=True)(_closest_per_photo)
+    min_per_group = numba.njit(cache=True)(_min_per_group)
+else:
+    # Same results as the loops above, built from vectorized numpy calls
+    def closest_per_photo(dots, sqnorms, guest_sqnorm, photo_starts):
+        dists = np.sqrt(np.maximum(0, sqnorms - 2 * dots + guest_sqnorm))
+        return np.minimum.reduceat(dists, photo_starts)
+
+    def min_per_group(values, group_ids, n_groups):
+        best = np.full(n_groups, np.inf, dtype=np.float32)
+        np.minimum.at(best, group_ids, values)
+        return best
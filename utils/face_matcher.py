@@ -1,100 +1,617 @@
 import cv2
+import dlib
 import face_recognition
+import face_recognition.api
+import face_recognition_models
 import numpy as np
 import os
-from PIL import Image, ExifTags
-import pickle
+from PIL import Image, ImageOps
+import atexit
+import collections
+import functools
+import hashlib
+import itertools
 import json
+import logging
+import multiprocessing
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 
+from _match_kernels import closest_per_photo, min_per_group
+
+try:
+    import faiss
+except ImportError:  # faiss is optional; only needed for approximate_search=True
+    faiss = None
+
+try:
+    import mediapipe as mp
+except ImportError:  # mediapipe is optional; only needed for detector='mediapipe'
+    mp = None
+
+try:
+    import pyvips
+except (ImportError, OSError):  # pyvips is optional and also needs the libvips library
+    pyvips = None
+
+try:
+    import fcntl
+except ImportError:  # no flock on Windows; every instance then writes the cache files
+    fcntl = None
+
+# Bump when the layout of cached encodings changes so old cache files get rebuilt
+CACHE_VERSION = 5
+
+# Cached encodings are stored as float16: they hold ~3 significant digits of signal,
+# so this halves the cache file and page cache traffic while distances move by
+# ~1e-4, far below the matching tolerance. Lookups and the match matrix are float32
+STORAGE_DTYPE = np.float16
+
+# Length of a dlib face encoding
+ENCODING_SIZE = 128
+
+# With approximate_search, weddings with at least this many faces are searched through
+# a faiss inverted-file index with ~sqrt(N) clusters, probing FAISS_NPROBE of them.
+# Its clusters are retrained once the wedding grows FAISS_RETRAIN_GROWTH-fold
+FAISS_IVF_MIN_FACES = 10000
+FAISS_NPROBE = 16
+FAISS_RETRAIN_GROWTH = 2
+
+# Images whose decoded encodings are kept hot in the in-memory LRU
+LRU_CACHE_SIZE = 8192
+
+# Pool workers are started once and kept, but starting them (spawned workers import
+# dlib and load the models) only pays off for backlogs of more than this many photos
+# per worker; smaller ones are encoded in the calling process
+POOL_MIN_PHOTOS_PER_WORKER = 4
+
+# Images per batched CNN detector call on the GPU
+GPU_BATCH_SIZE = 8
+
+# Without a process pool, photos are decoded on DECODE_THREADS threads while the
+# detector runs, at most DECODE_AHEAD photos ahead of it
+DECODE_THREADS = 4
+DECODE_AHEAD = 2 * GPU_BATCH_SIZE
+
+# A write-ahead log starts with a magic, CACHE_VERSION and the landmark model (5 or 68)
+# its encodings were aligned with, so a log left by a crash before the first save is
+# never replayed into a cache built with the other model
+_WAL_MAGIC = b'PFWL'
+_WAL_FILE_HEADER = struct.Struct('<4sHB')
+
+# Write-ahead log records: path length, then the path, then mtime, face count,
+# content digest (zeros if unknown) and whether face locations follow, then
+# face_count * ENCODING_SIZE float32 values and, if present, face_count * 4 int32
+# (top, right, bottom, left) locations
+_WAL_PATH_LEN = struct.Struct('<I')
+_WAL_HEADER = struct.Struct('<dI16s?')
+
+# Bytes hashed per read when fingerprinting a photo
+DIGEST_CHUNK_SIZE = 64 * 1024
+
+# The log is folded back into the .npy/.json snapshot after this many records
+WAL_COMPACT_RECORDS = 1000
+
+# Re-encoded photos leave their old rows behind in the .npy; save_cache packs the
+# live rows into a new file once the orphaned ones pass this share of all rows
+COMPACT_ORPHAN_SHARE = 0.25
+
+log = logging.getLogger(__name__)
+
+# Everything a search reads, built together and published as one object, so a cache
+# insert on another request thread can't change it halfway through a search
+MatchMatrix = collections.namedtuple('MatchMatrix', [
+    'matrix',        # (N, 128) float32, one row per wedding face
+    'sqnorms',       # (N,) squared row norms of matrix
+    'row_photo',     # photo number (into photo_files) of every row
+    'photo_starts',  # first row of each photo that has faces
+    'photo_files',   # filename for each entry of photo_starts
+    'photos',        # (path, mtime) pairs the matrix was built from
+    'stats',         # {'processed', 'errors'} counts of the build
+    'ivf_index',     # faiss IndexIVFFlat over matrix with approximate_search, else None
+])
+
+# Per-process matcher used by pool workers (see _encode_one)
+_worker_matcher = None
+
+
+def content_hasher():
+    """
+    New hash object for photo content digests. Callers that already stream a photo
+    (e.g. an upload) can feed it and hand the hexdigest to FaceMatcher.remember_digest.
+    """
+    return hashlib.blake2b(digest_size=16)
+
+
+def file_digest(image_path):
+    """Content digest of a photo, so a re-upload under another name hits the cache."""
+    hasher = content_hasher()
+    with open(image_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DIGEST_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _encode_one(image_path, model, detector='dlib', high_accuracy=False):
+    """
+    Detect and encode the faces in a single image inside a pool worker.
+    Kept at module level so ProcessPoolExecutor can pickle it.
+
+    Returns:
+        tuple: (image_path, encodings, locations, mtime). encodings, locations and
+               mtime are None if the image could not be processed, so the parent
+               never caches a failure.
+    """
+    global _worker_matcher
+    if (_worker_matcher is None or _worker_matcher.model != model
+            or _worker_matcher.detector != detector
+            or _worker_matcher.high_accuracy != high_accuracy):
+        _worker_matcher = FaceMatcher(model=model, cache_file=None, workers=1, detector=detector,
+                                      warmup=False, high_accuracy=high_accuracy)
+
+    try:
+        mtime = os.path.getmtime(image_path)
+        locations, encodings = _worker_matcher._compute_face_encodings(image_path)
+    except Exception as e:
+        log.warning("Error processing %s: %s", image_path, e)
+        return image_path, None, None, None
+    return image_path, encodings, locations, mtime
+
+
 class FaceMatcher:
     """
     A utility class for face detection, encoding, and matching in photos.
     """
     
-    def __init__(self, tolerance=0.45, model='cnn', min_confidence=0.55):
+    def __init__(self, tolerance=0.45, model='cnn', min_confidence=0.55,
+                 cache_file='face_encodings_cache.npy', workers=None, detector='dlib',
+                 warmup=True, verbose=False, high_accuracy=False, approximate_search=False):
         """
         Initialize the FaceMatcher with more strict settings.
         
         Args:
             tolerance (float): How strict the face matching should be. Lower is more strict.
                               Recommended: 0.4-0.5 for strict matching, 0.6 for loose matching
-            model (str): Face detection model to use ('hog' for CPU, 'cnn' for GPU)
+            model (str): dlib face detection model to use ('hog' for CPU, 'cnn' for GPU)
             min_confidence (float): Minimum confidence score to accept a match (0.0-1.0)
+            cache_file (str): .npy file holding every cached encoding; a JSON index and a
+                              write-ahead log of new encodings are kept next to it.
+                              Only one process at a time writes these files; other
+                              instances load a copy and keep new encodings in memory.
+                              None keeps the cache in memory only.
+            workers (int): Processes used to encode uncached photos. Defaults to one per CPU,
+                           or 1 when dlib runs on CUDA (a forked GPU context is not usable).
+            detector (str): Face detector: 'dlib' uses `model`, 'mediapipe' uses the much
+                            faster MediaPipe detector on CPU. Encoding always uses dlib, so
+                            encodings stay comparable with the existing cache.
+            warmup (bool): Run the models once at startup so the first guest search
+                           doesn't pay for model loading and CUDA/cuDNN setup.
+            verbose (bool): Log every photo (faces found, matches, rejections) at DEBUG
+                            level. Otherwise logging follows the application's config.
+            high_accuracy (bool): Align faces with the 68-point landmark model instead of
+                                  the ~10x faster 5-point one. Encodings from the two
+                                  aren't mixed: switching rebuilds the cache.
+            approximate_search (bool): Search weddings with FAISS_IVF_MIN_FACES or more
+                                       faces through a faiss IVF index. Faster per search,
+                                       but it only scans the clusters nearest to the guest,
+                                       so a few matches within tolerance can be missed.
         """
+        if verbose:
+            log.setLevel(logging.DEBUG)
         self.tolerance = tolerance
         self.model = model
         self.min_confidence = min_confidence  # Add minimum confidence threshold
+        if workers is None:
+            workers = 1 if dlib.DLIB_USE_CUDA else (os.cpu_count() or 1)
+        self.workers = workers
+        self.detector = detector
+        self._mp_detector = None
+        if detector == 'mediapipe':
+            if mp is None:
+                raise ImportError("detector='mediapipe' requires the mediapipe package")
+            self._mp_detector = mp.solutions.face_detection.FaceDetection(
+                model_selection=1, min_detection_confidence=0.5)
+        elif detector != 'dlib':
+            raise ValueError(f"Unknown face detector: {detector}")
+        # Landmark predictor and ResNet encoder, called directly so all faces of an
+        # image are encoded in one dlib call (the models face_recognition already loaded)
+        self.high_accuracy = high_accuracy
+        self.landmarks = 68 if high_accuracy else 5
+        if high_accuracy:
+            self._pose_predictor = face_recognition.api.pose_predictor_68_point
+        else:
+            self._pose_predictor = face_recognition.api.pose_predictor_5_point
+        self._face_encoder = face_recognition.api.face_encoder
+        if approximate_search and faiss is None:
+            raise ImportError("approximate_search=True requires the faiss package")
+        self.approximate_search = approximate_search
+        # (trained IVF index, faces it was trained on), reused across match matrix rebuilds
+        self._ivf_trained = None
+        # dlib can run the CNN detector on a whole batch of images in one GPU call
+        self._cnn_detector = None
+        if detector == 'dlib' and model == 'cnn' and dlib.DLIB_USE_CUDA:
+            self._cnn_detector = dlib.cnn_face_detection_model_v1(
+                face_recognition_models.cnn_face_detector_model_location())
+        self.cache_file = cache_file
+        self.index_file = os.path.splitext(cache_file)[0] + '.json' if cache_file else None
+        self.wal_file = os.path.splitext(cache_file)[0] + '.wal' if cache_file else None
+        self.lock_file = os.path.splitext(cache_file)[0] + '.lock' if cache_file else None
+        self._lock = None
+        self._owns_cache = False
+        self._wal = None
+        self._wal_records = 0
+        # Hot cache hits skip the dict lookup, freshness check and storage read
+        self._cached_lookup = functools.lru_cache(maxsize=LRU_CACHE_SIZE)(self._lookup_encodings)
+        # Request threads may search and encode concurrently: the lock serializes
+        # changes to the cache storage and files, and readers that copy rows out of it
+        self._cache_lock = threading.RLock()
+        # Encoding pool, started by the first backlog large enough to need it
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # Resize scratch buffers; request threads may encode concurrently
+        self._scratch = threading.local()
+        self._reset_cache()
+        if self.cache_file:
+            self._owns_cache = self._lock_cache()
+            self.load_cache()
+            if self._owns_cache:
+                self._replay_wal()
+                # Unbuffered, so every record reaches the OS as soon as it is written
+                self._wal = open(self.wal_file, 'ab', buffering=0)
+                if self._wal.tell() == 0:
+                    self._write_wal_header()
+                atexit.register(self.save_cache)
+        if warmup:
+            self.warmup()
+    
+    def _lock_cache(self):
+        """
+        Take the exclusive lock that makes this instance the one process writing the
+        cache files (replaying and compacting the WAL, growing and replacing the .npy).
+        
+        Returns:
+            bool: Whether this instance owns the cache
+        """
+        if fcntl is None:
+            return True
+        self._lock = open(self.lock_file, 'a')
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock.close()
+            self._lock = None
+            log.warning("%s is in use by another process; new encodings are kept in memory only",
+                        self.cache_file)
+            return False
+        return True
+    
+    def close(self):
+        """Save the cache and give up ownership of its files, e.g. before creating a new instance."""
+        self._shutdown_pool()
+        with self._cache_lock:
+            self.save_cache()
+            if self._owns_cache:
+                atexit.unregister(self.save_cache)
+                self._wal.close()
+                self._wal = None
+                if self._lock is not None:
+                    self._lock.close()
+                    self._lock = None
+                self._owns_cache = False
+                # Later encodings stay in memory instead of writing into the file
+                self._encodings = np.array(self._encodings[:self._rows])
+    
+    def _process_pool(self):
+        """
+        The pool that encodes uncached photos, started on first use and kept for the
+        life of the instance, so later backlogs don't pay for starting the workers again.
+        """
+        with self._pool_lock:
+            if self._pool is None:
+                # MediaPipe and libvips run their own threads, which a forked child
+                # inherits in whatever state they were in; start clean workers instead
+                forkable = self._mp_detector is None and pyvips is None
+                mp_context = None if forkable else multiprocessing.get_context('spawn')
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=mp_context)
+                atexit.register(self._shutdown_pool)
+            return self._pool
+    
+    def _shutdown_pool(self):
+        """Stop the encoding pool's workers, if it was started."""
+        with self._pool_lock:
+            if self._pool is not None:
+                atexit.unregister(self._shutdown_pool)
+                self._pool.shutdown()
+                self._pool = None
+    
+    def warmup(self):
+        """
+        Run detection and encoding once on a blank image, and the distance kernels
+        on one dummy face. dlib loads the CNN weights and picks its cuDNN algorithms
+        on first use, and numba compiles the kernels on their first call (or loads
+        them from its cache), which would otherwise add seconds to the first guest request.
+        """
+        dummy = np.zeros((64, 64, 3), dtype=np.uint8)
+        try:
+            self._detect_faces(dummy)
+            if self._cnn_detector is not None:
+                self._cnn_detector([dummy], 0, batch_size=1)
+            self._encode_faces(dummy, [(0, 63, 63, 0)])
+            # Same argument types as the calls in _closest_faces
+            closest_per_photo(np.zeros(1, dtype=np.float32), np.zeros(1, dtype=np.float32), 0.0,
+                              np.zeros(1, dtype=np.intp))
+            min_per_group(np.zeros(1, dtype=np.float32), np.zeros(1, dtype=np.intp), 1)
+        except Exception as e:
+            log.warning("Model warmup failed: %s", e)
+    
+    def _reset_cache(self):
+        """Start from an empty cache."""
+        # image_path -> {'row', 'face_count', 'timestamp', 'digest', 'locations'}; the encodings
+        # themselves live in rows [row, row + face_count) of self._encodings
         self.encodings_cache = {}
-        self.cache_file = 'face_encodings_cache.pkl'
-        self.load_cache()
+        # content digest -> a path cached with that content, to reuse its encodings
+        self._digest_paths = {}
+        # image_path -> (mtime, digest) computed or reported but not stored yet
+        self._pending_digests = {}
+        self._encodings = np.empty((0, ENCODING_SIZE), dtype=STORAGE_DTYPE)
+        self._rows = 0
+        # Whether the cache changed since it was last loaded or saved
+        self._dirty = False
+        self._cached_lookup.cache_clear()
+        self._invalidate_matrix()
     
     def load_cache(self):
-        """Load previously computed face encodings from cache file."""
+        """
+        Load previously computed face encodings from cache file.
+        The encodings are memory-mapped, so startup cost doesn't grow with the cache.
+        """
         try:
-            if os.path.exists(self.cache_file):
-                with open(self.cache_file, 'rb') as f:
-                    self.encodings_cache = pickle.load(f)
-                print(f"Loaded {len(self.encodings_cache)} cached encodings")
+            if os.path.exists(self.cache_file) and os.path.exists(self.index_file):
+                with open(self.index_file) as f:
+                    index = json.load(f)
+                if index.get('version') != CACHE_VERSION:
+                    log.info("Cache was written by an older version, it will be rebuilt")
+                    self._discard_wal()
+                    return
+                if index.get('landmarks', 5) != self.landmarks:
+                    log.info("Cache was built with the %s-point landmark model, it will be rebuilt",
+                             index.get('landmarks', 5))
+                    self._discard_wal()
+                    return
+                # Compacting shrinks the .npy before the index is rewritten; if a crash came
+                # in between, the index points at rows that have moved
+                if len(np.load(self.cache_file, mmap_mode='r')) < index.get('capacity', 0):
+                    log.warning("Cache index doesn't match the encodings file, the cache will be rebuilt")
+                    self._discard_wal()
+                    return
+                self._rows = index['rows']
+                if self._owns_cache:
+                    self._encodings = np.lib.format.open_memmap(self.cache_file, mode='r+')
+                else:
+                    # The owner may replace the file at any time, so never map it from here
+                    self._encodings = np.array(np.load(self.cache_file, mmap_mode='r')[:self._rows])
+                self.encodings_cache = index['entries']
+                self._digest_paths = {entry['digest']: path
+                                      for path, entry in self.encodings_cache.items()
+                                      if entry.get('digest')}
+                self._dirty = False
+                self._cached_lookup.cache_clear()
+                self._invalidate_matrix()
+                log.info("Loaded %d cached encodings", len(self.encodings_cache))
         except Exception as e:
-            print(f"Error loading cache: {e}")
-            self.encodings_cache = {}
+            log.error("Error loading cache: %s", e)
+            self._reset_cache()
     
-    def save_cache(self):
-        """Save computed face encodings to cache file for faster future processing."""
+    def _discard_wal(self):
+        """Drop a write-ahead log that belongs to a cache that is being rebuilt."""
+        if self._owns_cache and os.path.exists(self.wal_file):
+            open(self.wal_file, 'wb').close()
+    
+    def _replay_wal(self):
+        """
+        Re-apply encodings logged since the last save_cache. A record cut short by a
+        crash ends the replay; everything before it is kept.
+        """
+        if not os.path.exists(self.wal_file):
+            return
+        with open(self.wal_file, 'rb') as f:
+            data = f.read()
+        
+        if not data:
+            return
         try:
-            with open(self.cache_file, 'wb') as f:
-                pickle.dump(self.encodings_cache, f)
-            print(f"Saved {len(self.encodings_cache)} encodings to cache")
-        except Exception as e:
-            print(f"Error saving cache: {e}")
+            magic, version, landmarks = _WAL_FILE_HEADER.unpack_from(data)
+        except struct.error:
+            magic = version = landmarks = None
+        if (magic, version, landmarks) != (_WAL_MAGIC, CACHE_VERSION, self.landmarks):
+            log.info("Write-ahead log was written by another version or landmark model, discarding it")
+            self._discard_wal()
+            return
+        
+        offset = _WAL_FILE_HEADER.size
+        replayed = 0
+        while offset < len(data):
+            try:
+                (path_len,) = _WAL_PATH_LEN.unpack_from(data, offset)
+                offset += _WAL_PATH_LEN.size
+                image_path = data[offset:offset + path_len].decode('utf-8')
+                offset += path_len
+                mtime, face_count, digest, has_locations = _WAL_HEADER.unpack_from(data, offset)
+                offset += _WAL_HEADER.size
+            except (struct.error, UnicodeDecodeError):
+                break
+            size = face_count * ENCODING_SIZE * 4
+            locations_size = face_count * 4 * 4 if has_locations else 0
+            if offset + size + locations_size > len(data):
+                break
+            encodings = np.frombuffer(data, dtype=np.float32, count=face_count * ENCODING_SIZE,
+                                      offset=offset).reshape(face_count, ENCODING_SIZE)
+            offset += size
+            locations = None
+            if has_locations:
+                locations = np.frombuffer(data, dtype=np.int32, count=face_count * 4,
+                                          offset=offset).reshape(face_count, 4).tolist()
+                offset += locations_size
+            self._append_encodings(image_path, encodings, mtime,
+                                   digest.hex() if any(digest) else None, locations)
+            replayed += 1
+        
+        self._wal_records = replayed
+        if replayed:
+            log.info("Replayed %d encodings from the write-ahead log", replayed)
+    
+    def _write_wal_header(self):
+        """Start an empty write-ahead log with the header _replay_wal checks."""
+        self._wal.write(_WAL_FILE_HEADER.pack(_WAL_MAGIC, CACHE_VERSION, self.landmarks))
+    
+    def _log_encodings(self, image_path, encodings, mtime, digest, locations):
+        """Append one image's encodings to the write-ahead log in a single write."""
+        path_bytes = image_path.encode('utf-8')
+        matrix = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        digest_bytes = bytes.fromhex(digest) if digest else bytes(16)
+        record = (_WAL_PATH_LEN.pack(len(path_bytes)) + path_bytes
+                  + _WAL_HEADER.pack(mtime, len(matrix), digest_bytes, locations is not None)
+                  + matrix.tobytes())
+        if locations is not None:
+            record += np.asarray(locations, dtype=np.int32).reshape(-1, 4).tobytes()
+        self._wal.write(record)
+        self._wal_records += 1
+    
+    def save_cache(self):
+        """
+        Save computed face encodings to cache file for faster future processing.
+        New rows are already in the memory-mapped file, so this only flushes them,
+        rewrites the small JSON index and empties the write-ahead log. Searches don't
+        call this; it runs after batch processing, every WAL_COMPACT_RECORDS new
+        images and at exit, and does nothing if the cache hasn't changed.
+        """
+        with self._cache_lock:
+            if not self._owns_cache or not self._dirty:
+                return
+            try:
+                if not isinstance(self._encodings, np.memmap):
+                    self._grow_encodings(self._rows)
+                self._encodings.flush()
+                self._write_index()
+                live_rows = sum(entry['face_count'] for entry in self.encodings_cache.values())
+                if self._rows - live_rows > self._rows * COMPACT_ORPHAN_SHARE:
+                    # The index just written names the current file size, so a crash
+                    # before the compacted index replaces it is caught by load_cache
+                    self._compact_encodings()
+                    self._write_index()
+                if self._wal is not None:
+                    self._wal.truncate(0)
+                    self._write_wal_header()
+                self._wal_records = 0
+                self._dirty = False
+                log.info("Saved %d encodings to cache", len(self.encodings_cache))
+            except Exception as e:
+                log.error("Error saving cache: %s", e)
+    
+    def _write_index(self):
+        """
+        Write the JSON index next to the old one and swap it in, so an interrupted
+        save never leaves a truncated index behind.
+        """
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({
+                'version': CACHE_VERSION,
+                'landmarks': self.landmarks,
+                'rows': self._rows,
+                'capacity': len(self._encodings),
+                'entries': self.encodings_cache
+            }, f)
+        os.replace(tmp_file, self.index_file)
+    
+    def _grow_encodings(self, min_rows):
+        """
+        Reallocate the encoding storage to hold at least min_rows rows, doubling
+        the capacity so appends stay amortized O(1).
+        """
+        capacity = max(min_rows, 2 * len(self._encodings), 256)
+        self._rewrite_encodings(capacity, [(0, self._rows)])
+    
+    def _compact_encodings(self):
+        """
+        Pack the rows of cached images to the front of smaller storage, dropping the
+        rows of images that were encoded again since. The free space after the last
+        row is kept, so the file always shrinks (load_cache relies on that).
+        """
+        entries = sorted(self.encodings_cache.values(), key=lambda entry: entry['row'])
+        live_rows = sum(entry['face_count'] for entry in entries)
+        self._rewrite_encodings(len(self._encodings) - (self._rows - live_rows),
+                                [(entry['row'], entry['face_count']) for entry in entries])
+        row = 0
+        for entry in entries:
+            entry['row'] = row
+            row += entry['face_count']
+        log.info("Compacted the cache from %d to %d rows", self._rows, row)
+        self._rows = row
     
-    def fix_image_orientation(self, image_path):
+    def _rewrite_encodings(self, capacity, spans):
         """
-        Fix image orientation based on EXIF data.
-        Many phone photos have rotation info in EXIF that needs to be applied.
+        Copy the (row, count) spans of the encoding storage one after another into new
+        storage of capacity rows. When this instance owns the cache the new storage is
+        a memory-mapped .npy that replaces the old one.
         """
+        if self._owns_cache:
+            tmp_file = self.cache_file + '.tmp'
+            storage = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=STORAGE_DTYPE,
+                                                shape=(capacity, ENCODING_SIZE))
+        else:
+            storage = np.empty((capacity, ENCODING_SIZE), dtype=STORAGE_DTYPE)
+        row = 0
+        for start, count in spans:
+            storage[row:row + count] = self._encodings[start:start + count]
+            row += count
+        if not self._owns_cache:
+            self._encodings = storage
+            return
+        
+        storage.flush()
+        # Windows can't replace a file that is still mapped: unmap both files (every
+        # reader copies rows out under the cache lock) and map the new one again
+        del storage
+        self._encodings = None
         try:
-            image = Image.open(image_path)
-            
-            # Check if image has EXIF data
-            if hasattr(image, '_getexif'):
-                exif = image._getexif()
-                if exif is not None:
-                    # Look for orientation tag
-                    for tag, value in exif.items():
-                        decoded = ExifTags.TAGS.get(tag, tag)
-                        if decoded == 'Orientation':
-                            if value == 3:
-                                image = image.rotate(180, expand=True)
-                            elif value == 6:
-                                image = image.rotate(270, expand=True)
-                            elif value == 8:
-                                image = image.rotate(90, expand=True)
-                            break
-            
-            # Convert to RGB if necessary
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            return np.array(image)
-        except Exception as e:
-            print(f"Error fixing orientation for {image_path}: {e}")
-            # Fallback to basic loading
-            return face_recognition.load_image_file(image_path)
+            os.replace(tmp_file, self.cache_file)
+        finally:
+            self._encodings = np.lib.format.open_memmap(self.cache_file, mode='r+')
     
-    def preprocess_image(self, image_path, max_size=1024):
+    def preprocess_image(self, image_path, max_size=1024, out=None):
         """
         Preprocess image for better face recognition:
         - Fix orientation
         - Resize if too large
         - Enhance contrast if needed
+        
+        image_path may also be a binary file object, e.g. an upload stream.
+        out is an optional flat uint8 buffer to resize into instead of allocating;
+        the result may then be a view of it, valid until out is reused.
         """
+        if pyvips is not None and isinstance(image_path, str):
+            try:
+                return self._preprocess_with_vips(image_path, max_size)
+            except pyvips.Error as e:
+                log.warning("libvips could not load %s, falling back to PIL: %s", image_path, e)
+        
         try:
-            # Load and fix orientation
-            image = self.fix_image_orientation(image_path)
+            image = Image.open(image_path)
+            
+            # For JPEGs libjpeg scales by 1/2, 1/4 or 1/8 during decode, so a large
+            # photo is never decoded at full resolution (no-op for other formats)
+            image.draft('RGB', (max_size, max_size))
+            
+            # Fix orientation on the already reduced image
+            image = ImageOps.exif_transpose(image)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image = np.asarray(image)
             
-            # Resize if image is too large (for faster processing)
+            # Resize the rest of the way if image is still too large (for faster processing)
             height, width = image.shape[:2]
             if max(height, width) > max_size:
                 if width > height:
@@ -104,162 +621,655 @@ class FaceMatcher:
                     new_height = max_size
                     new_width = int((width * max_size) / height)
                 
-                image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
+                if out is not None and out.size >= new_height * new_width * 3:
+                    resized = out[:new_height * new_width * 3].reshape(new_height, new_width, 3)
+                    image = cv2.resize(image, (new_width, new_height), dst=resized,
+                                       interpolation=cv2.INTER_AREA)
+                else:
+                    image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
             
             return image
         except Exception as e:
-            print(f"Error preprocessing {image_path}: {e}")
+            log.warning("Error preprocessing %s: %s", image_path, e)
             return face_recognition.load_image_file(image_path)
     
-    def get_face_encodings(self, image_path, use_cache=True):
+    def _preprocess_with_vips(self, image_path, max_size):
+        """
+        Decode, orient and shrink an image in one libvips pass. thumbnail() uses
+        shrink-on-load and applies the EXIF orientation, so the full-resolution
+        image is never held in memory.
+        """
+        image = pyvips.Image.thumbnail(image_path, max_size, height=max_size, size='down')
+        if image.hasalpha():
+            image = image.flatten()
+        if image.interpretation != 'srgb':
+            image = image.colourspace('srgb')
+        if image.format != 'uchar':
+            image = image.cast('uchar')
+        return np.ndarray(buffer=image.write_to_memory(), dtype=np.uint8,
+                          shape=[image.height, image.width, image.bands])
+    
+    def _list_photos(self, folder, allowed_extensions):
+        """
+        List the photos in folder as (path, mtime) pairs. os.scandir hands back the
+        stat result with each entry, so callers never need to stat a photo again.
+        """
+        suffixes = frozenset('.' + ext for ext in allowed_extensions)
+        with os.scandir(folder) as entries:
+            return [(entry.path, entry.stat().st_mtime) for entry in entries
+                    if entry.is_file() and os.path.splitext(entry.name)[1].lower() in suffixes]
+    
+    def _is_cache_fresh(self, image_path, mtime=None):
+        """Check whether the cached encodings for image_path are newer than the file."""
+        cache_entry = self.encodings_cache.get(image_path)
+        if cache_entry is None:
+            return False
+        if mtime is None:
+            mtime = os.path.getmtime(image_path)
+        return cache_entry['timestamp'] >= mtime
+    
+    def get_face_encodings_from_array(self, image):
+        """
+        Detect and encode the faces in an RGB image that is already in memory,
+        e.g. the output of preprocess_image. Nothing is cached.
+        
+        Args:
+            image (np.ndarray): (height, width, 3) uint8 RGB image
+            
+        Returns:
+            list: List of float32 face encodings found in the image
+        """
+        return self._detect_and_encode(image)[1]
+    
+    def _detect_and_encode(self, image):
+        """Return (face_locations, face_encodings) for an RGB image."""
+        # Find face locations first
+        face_locations = self._detect_faces(image)
+        
+        if not face_locations:
+            return [], []
+        
+        return face_locations, self._encode_faces(image, face_locations)
+    
+    def _detect_faces(self, image):
+        """
+        Find the faces in an RGB image with the configured detector.
+        
+        Returns:
+            list: (top, right, bottom, left) tuples in pixel coordinates
+        """
+        if self._mp_detector is None:
+            return face_recognition.face_locations(image, model=self.model)
+        
+        height, width = image.shape[:2]
+        result = self._mp_detector.process(image)
+        face_locations = []
+        for detection in result.detections or []:
+            # MediaPipe boxes are relative and may reach past the image border
+            box = detection.location_data.relative_bounding_box
+            top = max(int(box.ymin * height), 0)
+            left = max(int(box.xmin * width), 0)
+            bottom = min(int((box.ymin + box.height) * height), height)
+            right = min(int((box.xmin + box.width) * width), width)
+            if bottom > top and right > left:
+                face_locations.append((top, right, bottom, left))
+        return face_locations
+    
+    def _encode_faces(self, image, face_locations):
+        """
+        Compute the 128-D encodings of the given faces in one dlib call: landmarks
+        per face (5- or 68-point, see high_accuracy), then a single batched
+        compute_face_descriptor.
+        
+        Args:
+            image (np.ndarray): RGB image the faces were found in
+            face_locations (list): (top, right, bottom, left) tuples
+            
+        Returns:
+            list: One float32 encoding per face
+        """
+        shapes = dlib.full_object_detections()
+        for top, right, bottom, left in face_locations:
+            shapes.append(self._pose_predictor(image, dlib.rectangle(left, top, right, bottom)))
+        
+        # dlib only carries single-precision signal, so float32 halves the match
+        # matrix without losing accuracy (the cache stores STORAGE_DTYPE)
+        descriptors = self._face_encoder.compute_face_descriptor(image, shapes, 1)
+        return [np.array(descriptor, dtype=np.float32) for descriptor in descriptors]
+    
+    def _compute_face_encodings(self, image_path, image=None):
+        """
+        Run preprocessing, detection and encoding on one image, bypassing the cache.
+        image is the already preprocessed photo, if the caller decoded it.
+        Errors are raised to the caller.
+        
+        Returns:
+            tuple: (face_locations, face_encodings)
+        """
+        if image is None:
+            # The image dies with this call, so the resize can reuse this thread's buffer
+            image = self.preprocess_image(image_path, out=self._resize_buffer())
+        face_locations, face_encodings = self._detect_and_encode(image)
+        
+        if face_encodings:
+            log.debug("Found %d face(s) in %s", len(face_encodings), os.path.basename(image_path))
+        else:
+            log.debug("No faces found in %s", image_path)
+        return face_locations, face_encodings
+    
+    def _resize_buffer(self):
+        """Per-thread scratch buffer for preprocess_image's resize, allocated on first use."""
+        buffer = getattr(self._scratch, 'buffer', None)
+        if buffer is None:
+            buffer = self._scratch.buffer = np.empty(1024 * 1024 * 3, dtype=np.uint8)
+        return buffer
+    
+    def get_face_encodings(self, image_path, use_cache=True, mtime=None):
         """
         Extract face encodings from an image with caching and preprocessing.
         
         Args:
             image_path (str): Path to the image file
             use_cache (bool): Whether to use/update cache
+            mtime (float): Modification time of the file if the caller already has it,
+                           saves a stat syscall per cache lookup
             
         Returns:
-            list: List of face encodings found in the image
+            list: Face encodings found in the image. Cache hits are a read-only
+                  (faces, 128) float32 array shared with the LRU, don't modify it.
+        """
+        if mtime is None:
+            mtime = os.path.getmtime(image_path)
+        
+        # Check cache first (also checks the file hasn't been modified since caching)
+        if use_cache:
+            try:
+                return self._cached_lookup(image_path, mtime)
+            except KeyError:
+                pass
+        
+        try:
+            if use_cache and self._reuse_duplicate(image_path, mtime):
+                return self._cached_lookup(image_path, mtime)
+            face_locations, face_encodings = self._compute_face_encodings(image_path)
+        except Exception as e:
+            log.warning("Error processing %s: %s", image_path, e)
+            return []
+        
+        # Cache the results (photos without faces too, so they aren't re-detected)
+        if use_cache:
+            self._store_encodings(image_path, face_encodings, mtime, face_locations)
+        
+        return face_encodings
+    
+    def _lookup_encodings(self, image_path, mtime):
+        """
+        Read an image's encodings out of the cache storage. Called through the LRU
+        in self._cached_lookup; keying on mtime means a modified file simply misses.
+        
+        Raises:
+            KeyError: If the image has no cache entry at least as new as mtime
         """
-        # Check cache first
-        if use_cache and image_path in self.encodings_cache:
+        with self._cache_lock:
             cache_entry = self.encodings_cache[image_path]
-            # Check if file has been modified since caching
-            file_mod_time = os.path.getmtime(image_path)
-            if cache_entry['timestamp'] >= file_mod_time:
-                return cache_entry['encodings']
+            if cache_entry['timestamp'] < mtime:
+                raise KeyError(image_path)
+            row = cache_entry['row']
+            encodings = np.array(self._encodings[row:row + cache_entry['face_count']], dtype=np.float32)
+            encodings.flags.writeable = False
+            return encodings
+    
+    def remember_digest(self, image_path, digest):
+        """
+        Record the content digest (see content_hasher) of a photo that was just written,
+        so it isn't read a second time to fingerprint it.
+        """
+        self._pending_digests[image_path] = (os.path.getmtime(image_path), digest)
+    
+    def _file_digest(self, image_path, mtime):
+        """Content digest of image_path as of mtime, hashing the file only if nobody reported it."""
+        pending = self._pending_digests.get(image_path)
+        if pending is not None and pending[0] == mtime:
+            return pending[1]
+        digest = file_digest(image_path)
+        self._pending_digests[image_path] = (mtime, digest)
+        return digest
+    
+    def _reuse_duplicate(self, image_path, mtime):
+        """
+        Cache image_path with the encodings of an already cached photo with the same
+        content (e.g. the same photo uploaded twice), skipping detection and encoding.
         
+        Returns:
+            bool: Whether a duplicate was found
+        """
+        digest = self._file_digest(image_path, mtime)
+        with self._cache_lock:
+            original = self._digest_paths.get(digest)
+            if original is None or original == image_path:
+                return False
+            entry = self.encodings_cache[original]
+            row = entry['row']
+            self._store_encodings(image_path, np.array(self._encodings[row:row + entry['face_count']]), mtime,
+                                  entry.get('locations'))
+            return True
+    
+    def _store_encodings(self, image_path, encodings, mtime, locations=None):
+        """
+        Add one image's encodings, and the (top, right, bottom, left) face locations
+        they were computed from if known, to the cache and log them so they survive a crash.
+        """
         try:
-            # Preprocess the image
-            image = self.preprocess_image(image_path)
-            
-            # Find face locations first
-            face_locations = face_recognition.face_locations(image, model=self.model)
-            
-            if not face_locations:
-                print(f"No faces found in {image_path}")
-                return []
+            digest = self._file_digest(image_path, mtime)
+        except OSError:
+            digest = None
+        with self._cache_lock:
+            self._pending_digests.pop(image_path, None)
+            self._append_encodings(image_path, encodings, mtime, digest, locations)
+            if self._wal is not None:
+                self._log_encodings(image_path, encodings, mtime, digest, locations)
+                if self._wal_records >= WAL_COMPACT_RECORDS:
+                    self.save_cache()
+    
+    def _append_encodings(self, image_path, encodings, mtime, digest=None, locations=None):
+        """Append one image's encodings to the cache and drop the stale match matrix."""
+        face_count = len(encodings)
+        if self._rows + face_count > len(self._encodings):
+            self._grow_encodings(self._rows + face_count)
+        if face_count:
+            self._encodings[self._rows:self._rows + face_count] = encodings
+        # A photo edited in place no longer holds the content its old digest names
+        previous = self.encodings_cache.get(image_path)
+        if (previous is not None and previous.get('digest') != digest
+                and self._digest_paths.get(previous.get('digest')) == image_path):
+            del self._digest_paths[previous['digest']]
+        self.encodings_cache[image_path] = {
+            'row': self._rows,
+            'face_count': face_count,
+            'timestamp': mtime,
+            'digest': digest,
+            'locations': None if locations is None else [[int(v) for v in location]
+                                                         for location in locations]
+        }
+        if digest:
+            self._digest_paths[digest] = image_path
+        self._rows += face_count
+        self._dirty = True
+        self._invalidate_matrix()
+    
+    def _uncached_photos(self, photos):
+        """Return the (path, mtime) pairs without a fresh cache entry (unreadable ones included)."""
+        pending = []
+        for photo_path, mtime in photos:
+            try:
+                if not self._is_cache_fresh(photo_path, mtime):
+                    if mtime is None:
+                        mtime = os.path.getmtime(photo_path)
+                    if not self._reuse_duplicate(photo_path, mtime):
+                        pending.append((photo_path, mtime))
+            except OSError:
+                pending.append((photo_path, mtime))
+        return pending
+    
+    def encode_uncached_photos(self, photos):
+        """
+        Encode every photo that has no fresh cache entry, spreading the work over
+        a process pool. dlib runs single-threaded per image, so this is where
+        multiple cores pay off on a cold cache; a few misses (e.g. new uploads
+        before a guest search) are encoded here instead.
+        
+        Args:
+            photos (list): (path, mtime) pairs of the photos to make sure are cached;
+                           mtime may be None
             
-            # Get face encodings
-            face_encodings = face_recognition.face_encodings(image, face_locations)
+        Returns:
+            int: Number of photos that had to be encoded
+        """
+        pending = self._uncached_photos(photos)
+        
+        if self.workers <= 1 or len(pending) <= self.workers * POOL_MIN_PHOTOS_PER_WORKER:
+            # Decode the next photos while this thread runs detection and encoding
+            for photo_path, mtime, image in self._decode_ahead(pending):
+                if image is None:
+                    continue
+                try:
+                    locations, encodings = self._compute_face_encodings(photo_path, image)
+                except Exception as e:
+                    log.warning("Error processing %s: %s", photo_path, e)
+                    continue
+                self._store_encodings(photo_path, encodings, mtime, locations)
+            return len(pending)
+        
+        log.info("Encoding %d uncached photos with %d workers...", len(pending), self.workers)
+        executor = self._process_pool()
+        for photo_path, encodings, locations, mtime in executor.map(_encode_one,
+                                                                    [photo_path for photo_path, _ in pending],
+                                                                    [self.model] * len(pending),
+                                                                    [self.detector] * len(pending),
+                                                                    [self.high_accuracy] * len(pending),
+                                                                    chunksize=4):
+            if encodings is not None:
+                self._store_encodings(photo_path, encodings, mtime, locations)
+        
+        return len(pending)
+    
+    def encode_photos_batched(self, photos, batch_size=GPU_BATCH_SIZE):
+        """
+        Encode uncached photos with batched CNN detection on the GPU. Each batch is
+        zero-padded to a common shape and detected in a single dlib call, which
+        saves the per-image kernel launch and host-to-device copy overhead.
+        
+        Args:
+            photos (list): (path, mtime) pairs of the photos to make sure are cached;
+                           mtime may be None
+            batch_size (int): Images per detector call
             
-            # Cache the results
-            if use_cache:
-                self.encodings_cache[image_path] = {
-                    'encodings': face_encodings,
-                    'timestamp': os.path.getmtime(image_path),
-                    'face_count': len(face_encodings)
-                }
+        Returns:
+            int: Number of photos that had to be encoded
+        """
+        pending = self._uncached_photos(photos)
+        
+        for loaded, batch in self._padded_batches(pending, batch_size):
+            if not loaded:
+                continue
             
-            print(f"Found {len(face_encodings)} face(s) in {os.path.basename(image_path)}")
-            return face_encodings
+            # Upsample once, like face_recognition.face_locations does by default
+            detections = self._cnn_detector(batch, 1, batch_size=len(batch))
             
-        except Exception as e:
-            print(f"Error processing {image_path}: {e}")
-            return []
+            for (photo_path, mtime, image), faces in zip(loaded, detections):
+                img_height, img_width = image.shape[:2]
+                face_locations = [(max(face.rect.top(), 0), min(face.rect.right(), img_width),
+                                   min(face.rect.bottom(), img_height), max(face.rect.left(), 0))
+                                  for face in faces]
+                face_encodings = self._encode_faces(image, face_locations) if face_locations else []
+                if face_encodings:
+                    log.debug("Found %d face(s) in %s", len(face_encodings), os.path.basename(photo_path))
+                else:
+                    log.debug("No faces found in %s", photo_path)
+                self._store_encodings(photo_path, face_encodings, mtime, face_locations)
+        
+        return len(pending)
     
-    def find_matching_photos(self, guest_photo_path, wedding_photos_folder, allowed_extensions=None):
+    def _padded_batches(self, pending, batch_size):
         """
-        Find all wedding photos that contain the guest's face with improved filtering.
+        Yield (loaded, batch) for consecutive batch_size slices of pending, where
+        loaded holds the (path, mtime, image) triples that could be read and batch
+        their images zero-padded to a common shape. A loader thread assembles the
+        next batch while the caller runs the detector on the current one, so the
+        GPU doesn't wait on decoding and padding between batches.
         """
-        if allowed_extensions is None:
-            allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff'}
+        decoded = self._decode_ahead(pending)
         
-        # Get guest face encodings
-        guest_encodings = self.get_face_encodings(guest_photo_path)
+        def assemble():
+            loaded = [(photo_path, mtime, image)
+                      for photo_path, mtime, image in itertools.islice(decoded, batch_size)
+                      if image is not None]
+            if not loaded:
+                return loaded, []
+            # Pad at the bottom/right so detections keep the original image coordinates
+            height = max(image.shape[0] for _, _, image in loaded)
+            width = max(image.shape[1] for _, _, image in loaded)
+            padded = np.zeros((len(loaded), height, width, 3), dtype=np.uint8)
+            for slot, (_, _, image) in zip(padded, loaded):
+                slot[:image.shape[0], :image.shape[1]] = image
+            return loaded, list(padded)
         
-        if not guest_encodings:
-            return {
-                'success': False,
-                'error': 'No face detected in the guest photo. Please upload a clear photo with a visible face.',
-                'matches': [],
-                'stats': {}
-            }
-        
-        # Use the first (and presumably primary) face encoding
-        guest_encoding = guest_encodings[0]
+        n_batches = -(-len(pending) // batch_size)
+        with ThreadPoolExecutor(max_workers=1) as loader:
+            upcoming = loader.submit(assemble) if n_batches else None
+            for index in range(n_batches):
+                current = upcoming.result()
+                if index + 1 < n_batches:
+                    upcoming = loader.submit(assemble)
+                yield current
+    
+    def _decode_ahead(self, pending):
+        """
+        Yield (path, mtime, image) for (path, mtime) pairs in order, preprocessing up
+        to DECODE_AHEAD photos on a thread pool ahead of the consumer. File reads,
+        JPEG decoding and resizing release the GIL, so they overlap with dlib.
+        image is None if the photo could not be read.
+        """
+        def load(photo_path, mtime):
+            try:
+                if mtime is None:
+                    mtime = os.path.getmtime(photo_path)
+                return photo_path, mtime, self.preprocess_image(photo_path)
+            except Exception as e:
+                log.warning("Error processing %s: %s", photo_path, e)
+                return photo_path, mtime, None
         
-        matches = []
-        processed_count = 0
-        error_count = 0
-        total_faces_found = 0
-        rejected_low_confidence = 0
+        with ThreadPoolExecutor(max_workers=DECODE_THREADS) as executor:
+            ahead = collections.deque()
+            for photo_path, mtime in pending:
+                ahead.append(executor.submit(load, photo_path, mtime))
+                if len(ahead) >= DECODE_AHEAD:
+                    yield ahead.popleft().result()
+            while ahead:
+                yield ahead.popleft().result()
+    
+    def _encode_misses(self, photos):
+        """Encode uncached photos in CNN batches on a CUDA build of dlib, else across the process pool."""
+        if self._cnn_detector is not None:
+            return self.encode_photos_batched(photos)
+        return self.encode_uncached_photos(photos)
+    
+    def _invalidate_matrix(self):
+        """Forget the stacked match matrix; it is rebuilt on the next search."""
+        self._match = None
+        # Bumped on every invalidation, so a build that raced with a cache insert isn't kept
+        self._match_generation = getattr(self, '_match_generation', 0) + 1
+    
+    def _build_match_matrix(self, photos):
+        """
+        Stack the cached encodings of photos ((path, mtime) pairs) into one contiguous float32 matrix
+        so a guest can be compared against every wedding face with a single GEMV.
+        The matrix is reused until the cache changes or the photo list does.
         
-        # Get all wedding photo files
-        wedding_files = [f for f in os.listdir(wedding_photos_folder) 
-                        if f.lower().split('.')[-1] in allowed_extensions]
+        Returns:
+            MatchMatrix: The matrix to search; never modified once built
+        """
+        match = self._match
+        if match is not None and match.photos == photos:
+            return match
+        generation = self._match_generation
         
-        print(f"Processing {len(wedding_files)} wedding photos...")
-        print(f"Using tolerance: {self.tolerance}, min_confidence: {self.min_confidence}")
+        rows = []
+        photo_starts = []
+        photo_files = []
+        processed = 0
+        errors = 0
         
-        for filename in wedding_files:
+        for photo_path, mtime in photos:
+            filename = os.path.basename(photo_path)
             try:
-                photo_path = os.path.join(wedding_photos_folder, filename)
-                wedding_encodings = self.get_face_encodings(photo_path)
-                
-                processed_count += 1
-                total_faces_found += len(wedding_encodings)
-                
-                # Check each face in the wedding photo
-                best_match_confidence = 0
-                best_match_distance = float('inf')
-                
-                for i, wedding_encoding in enumerate(wedding_encodings):
-                    # Compare faces
-                    face_distances = face_recognition.face_distance([wedding_encoding], guest_encoding)
-                    face_distance = face_distances[0]
-                    confidence = 1 - face_distance
-                    
-                    # Check both tolerance and minimum confidence
-                    if face_distance <= self.tolerance and confidence >= self.min_confidence:
-                        # Keep track of the best match in this photo
-                        if confidence > best_match_confidence:
-                            best_match_confidence = confidence
-                            best_match_distance = face_distance
-                
-                # Only add the photo if we found a good match
-                if best_match_confidence > 0:
-                    matches.append({
-                        'filename': filename,
-                        'path': f'/static/uploads/wedding_photos/{filename}',
-                        'confidence': float(best_match_confidence),
-                        'face_distance': float(best_match_distance)
-                    })
-                    print(f"✓ Strong match in {filename} (confidence: {best_match_confidence:.3f}, distance: {best_match_distance:.3f})")
-                else:
-                    # Check if there were faces but they didn't meet our criteria
-                    for wedding_encoding in wedding_encodings:
-                        face_distance = face_recognition.face_distance([wedding_encoding], guest_encoding)[0]
-                        if face_distance <= self.tolerance:  # Met tolerance but not confidence
-                            rejected_low_confidence += 1
-                            print(f"✗ Rejected {filename} - low confidence: {1-face_distance:.3f}")
-                            break
-                
+                encodings = self.get_face_encodings(photo_path, mtime=mtime)
             except Exception as e:
-                print(f"Error processing {filename}: {e}")
-                error_count += 1
+                log.warning("Error processing %s: %s", filename, e)
+                errors += 1
                 continue
+            
+            processed += 1
+            if len(encodings):
+                photo_starts.append(len(rows))
+                photo_files.append(filename)
+                rows.extend(encodings)
         
-        # Save updated cache
-        self.save_cache()
+        if rows:
+            matrix = np.ascontiguousarray(np.vstack(rows), dtype=np.float32)
+        else:
+            matrix = np.empty((0, 128), dtype=np.float32)
+        photo_starts = np.asarray(photo_starts, dtype=np.intp)
+        ivf_index = None
+        if self.approximate_search and len(rows) >= FAISS_IVF_MIN_FACES:
+            ivf_index = self._build_ivf_index(matrix)
+        match = MatchMatrix(
+            matrix=matrix,
+            sqnorms=np.einsum('ij,ij->i', matrix, matrix),
+            row_photo=np.repeat(np.arange(len(photo_starts)), np.diff(np.append(photo_starts, len(rows)))),
+            photo_starts=photo_starts,
+            photo_files=photo_files,
+            photos=list(photos),
+            stats={'processed': processed, 'errors': errors},
+            ivf_index=ivf_index
+        )
+        with self._cache_lock:
+            if self._match_generation == generation:
+                self._match = match
+        return match
+    
+    def _build_ivf_index(self, matrix):
+        """
+        Cluster the wedding faces so a search only scans the FAISS_NPROBE clusters
+        nearest to the guest instead of every face. Training the clusters is the slow
+        part, so later rebuilds fill a copy of the trained, empty index until the
+        wedding has grown FAISS_RETRAIN_GROWTH-fold.
+        """
+        trained, trained_faces = self._ivf_trained or (None, 0)
+        if trained is None or len(matrix) > FAISS_RETRAIN_GROWTH * trained_faces:
+            nlist = int(np.sqrt(len(matrix)))
+            trained = faiss.IndexIVFFlat(faiss.IndexFlatL2(ENCODING_SIZE), ENCODING_SIZE, nlist)
+            trained.train(matrix)
+            self._ivf_trained = (trained, len(matrix))
+        # Searches may still be using earlier indexes, so never refill one in place
+        index = faiss.clone_index(trained)
+        index.nprobe = min(FAISS_NPROBE, trained.nlist)
+        index.add(matrix)
+        return index
+    
+    def _closest_faces(self, match, guest_encodings):
+        """
+        Find the closest face of every wedding photo that is within tolerance, for
+        one or more guests at once.
+        
+        Args:
+            match (MatchMatrix): Wedding faces to search, from _build_match_matrix
+            guest_encodings (np.ndarray): (k, 128) guest encodings
+        
+        Returns:
+            list: One (photo_indices, distances) pair of arrays per guest, photo
+                  indices into match.photo_files
+        """
+        G = np.asarray(guest_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        if not len(match.photo_starts):
+            return [(np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32))] * len(G)
+        
+        if match.ivf_index is not None:
+            # faiss works on squared L2 distances
+            lims, sq_dists, rows = match.ivf_index.range_search(G, self.tolerance ** 2)
+            all_best = [min_per_group(np.sqrt(sq_dists[lims[i]:lims[i + 1]]),
+                                      match.row_photo[rows[lims[i]:lims[i + 1]]],
+                                      len(match.photo_files))
+                        for i in range(len(G))]
+        else:
+            # One GEMV (GEMM for several guests) against every wedding face,
+            # then the closest face of each photo
+            dots = G @ match.matrix.T
+            guest_sqnorms = np.einsum('ij,ij->i', G, G)
+            all_best = [closest_per_photo(dots[i], match.sqnorms, float(guest_sqnorms[i]),
+                                          match.photo_starts)
+                        for i in range(len(G))]
+        
+        results = []
+        for best_distances in all_best:
+            photo_indices = np.flatnonzero(best_distances <= self.tolerance)
+            results.append((photo_indices, best_distances[photo_indices]))
+        return results
+    
+    def _preprocess_guest(self, guest_photo):
+        """preprocess_image for a guest photo (path or binary file object); None if it can't be decoded."""
+        try:
+            return self.preprocess_image(guest_photo)
+        except Exception as e:
+            log.warning("Error processing guest photo: %s", e)
+            return None
+    
+    def _guest_encoding(self, image):
+        """
+        Encode the primary face of a decoded guest photo, or return None if no face
+        is found. Not cached: the guest photo is temporary, and a cache insert would
+        invalidate the match matrix on every search.
+        """
+        if image is None:
+            return None
+        try:
+            guest_encodings = self.get_face_encodings_from_array(image)
+        except Exception as e:
+            log.warning("Error processing guest photo: %s", e)
+            return None
+        
+        # Use the first (and presumably primary) face encoding
+        return guest_encodings[0] if len(guest_encodings) else None
+    
+    def _prepare_matrix(self, wedding_photos_folder, allowed_extensions):
+        """Make sure every wedding photo is cached and return the MatchMatrix of all of them."""
+        if allowed_extensions is None:
+            allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff'}
+        
+        # Get all wedding photo files
+        photos = self._list_photos(wedding_photos_folder, allowed_extensions)
+        
+        log.info("Processing %d wedding photos...", len(photos))
+        log.info("Using tolerance: %s, min_confidence: %s", self.tolerance, self.min_confidence)
         
-        # Sort matches by confidence (highest first)
-        matches.sort(key=lambda x: x['confidence'], reverse=True)
+        # Encode cache misses, then stack every cached face into one matrix
+        self._encode_misses(photos)
+        return self._build_match_matrix(photos)
+    
+    def _no_face_result(self):
+        """Result returned for a guest photo without a usable face."""
+        return {
+            'success': False,
+            'error': 'No face detected in the guest photo. Please upload a clear photo with a visible face.',
+            'matches': [],
+            'stats': {}
+        }
+    
+    def _match_result(self, match, photo_indices, distances):
+        """Turn one guest's closest faces in match into the result dict returned by find_matching_photos."""
+        photo_indices = np.asarray(photo_indices, dtype=np.intp)
+        distances = np.asarray(distances, dtype=np.float64)
+        
+        # Check both tolerance and minimum confidence (confidence = 1 - distance)
+        strong = 1 - distances >= self.min_confidence
+        rejected_low_confidence = int(len(distances) - np.count_nonzero(strong))
+        if log.isEnabledFor(logging.DEBUG):
+            for photo_idx, distance, keep in zip(photo_indices, distances, strong):
+                filename = match.photo_files[photo_idx]
+                if keep:
+                    log.debug("✓ Strong match in %s (confidence: %.3f, distance: %.3f)",
+                              filename, 1 - distance, distance)
+                else:
+                    # Met tolerance but not confidence
+                    log.debug("✗ Rejected %s - low confidence: %.3f", filename, 1 - distance)
+        
+        # Sort the survivors by confidence (highest first) before building any dicts
+        photo_indices, distances = photo_indices[strong], distances[strong]
+        order = np.argsort(distances, kind='stable')
+        matches = []
+        for photo_idx, distance in zip(photo_indices[order].tolist(), distances[order].tolist()):
+            filename = match.photo_files[photo_idx]
+            matches.append({
+                'filename': filename,
+                'path': f'/static/uploads/wedding_photos/{filename}',
+                'confidence': 1 - distance,
+                'face_distance': distance
+            })
         
         stats = {
-            'total_photos_processed': processed_count,
-            'total_faces_found': total_faces_found,
+            'total_photos_processed': match.stats['processed'],
+            'total_faces_found': len(match.matrix),
             'rejected_low_confidence': rejected_low_confidence,
-            'errors': error_count,
+            'errors': match.stats['errors'],
             'average_confidence': sum(m['confidence'] for m in matches) / len(matches) if matches else 0,
             'tolerance_used': self.tolerance,
             'min_confidence_used': self.min_confidence
         }
         
-        print(f"\nResults: {len(matches)} matches found, {rejected_low_confidence} rejected for low confidence")
+        log.info("Results: %d matches found, %d rejected for low confidence",
+                 len(matches), rejected_low_confidence)
         if matches:
-            print(f"Confidence range: {min(m['confidence'] for m in matches):.3f} - {max(m['confidence'] for m in matches):.3f}")
+            log.info("Confidence range: %.3f - %.3f", matches[-1]['confidence'], matches[0]['confidence'])
         
         return {
             'success': True,
@@ -268,6 +1278,60 @@ class FaceMatcher:
             'stats': stats
         }
     
+    def find_matching_photos(self, guest_photo, wedding_photos_folder, allowed_extensions=None):
+        """
+        Find all wedding photos that contain the guest's face with improved filtering.
+        
+        Args:
+            guest_photo: Path of the guest photo, or a binary file object such as an
+                         upload stream (decoded in memory, never written to disk)
+            wedding_photos_folder (str): Folder containing wedding photos
+            allowed_extensions (set): Set of allowed file extensions
+        """
+        guest_encoding = self._guest_encoding(self._preprocess_guest(guest_photo))
+        if guest_encoding is None:
+            return self._no_face_result()
+        
+        match = self._prepare_matrix(wedding_photos_folder, allowed_extensions)
+        
+        return self._match_result(match, *self._closest_faces(match, guest_encoding)[0])
+    
+    def find_matching_photos_batch(self, guest_photos, wedding_photos_folder, allowed_extensions=None):
+        """
+        Match several guests against the same match matrix, with one GEMM instead of
+        one GEMV per guest (e.g. a photo booth uploading many guests at once).
+        
+        Args:
+            guest_photos (list): Guest photo paths or binary file objects
+            wedding_photos_folder (str): Folder containing wedding photos
+            allowed_extensions (set): Set of allowed file extensions
+            
+        Returns:
+            list: One find_matching_photos result per guest photo, in the same order
+        """
+        # Decoding and resizing release the GIL, so overlap them in threads. Detection
+        # and encoding stay on this thread: dlib's networks are not safe to share
+        max_workers = max(1, min(len(guest_photos), os.cpu_count() or 1))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            images = list(executor.map(self._preprocess_guest, guest_photos))
+        
+        guest_encodings = [self._guest_encoding(image) for image in images]
+        
+        found = [encoding for encoding in guest_encodings if encoding is not None]
+        closest = []
+        if found:
+            match = self._prepare_matrix(wedding_photos_folder, allowed_extensions)
+            closest = self._closest_faces(match, np.vstack(found))
+        
+        results = []
+        closest = iter(closest)
+        for encoding in guest_encodings:
+            if encoding is None:
+                results.append(self._no_face_result())
+            else:
+                results.append(self._match_result(match, *next(closest)))
+        return results
+    
     def batch_process_wedding_photos(self, wedding_photos_folder, allowed_extensions=None):
         """
         Pre-process all wedding photos to build face encoding cache.
@@ -283,34 +1347,36 @@ class FaceMatcher:
         if allowed_extensions is None:
             allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff'}
         
-        wedding_files = [f for f in os.listdir(wedding_photos_folder) 
-                        if f.lower().split('.')[-1] in allowed_extensions]
+        photos = self._list_photos(wedding_photos_folder, allowed_extensions)
         
         processed = 0
         errors = 0
         total_faces = 0
         
-        print(f"Batch processing {len(wedding_files)} wedding photos...")
+        log.info("Batch processing %d wedding photos...", len(photos))
+        
+        # Encode every cache miss up front; the loop below then only hits the cache
+        self._encode_misses(photos)
         
-        for filename in wedding_files:
+        for photo_path, mtime in photos:
             try:
-                photo_path = os.path.join(wedding_photos_folder, filename)
-                encodings = self.get_face_encodings(photo_path, use_cache=True)
+                encodings = self.get_face_encodings(photo_path, use_cache=True, mtime=mtime)
                 total_faces += len(encodings)
                 processed += 1
                 
                 if processed % 10 == 0:
-                    print(f"Processed {processed}/{len(wedding_files)} photos...")
+                    log.debug("Processed %d/%d photos...", processed, len(photos))
                     
             except Exception as e:
-                print(f"Error batch processing {filename}: {e}")
+                log.warning("Error batch processing %s: %s", os.path.basename(photo_path), e)
                 errors += 1
         
-        # Save cache after batch processing
+        # Save cache after batch processing and stack it for guest searches
         self.save_cache()
+        self._build_match_matrix(photos)
         
         return {
-            'total_files': len(wedding_files),
+            'total_files': len(photos),
             'processed': processed,
             'errors': errors,
             'total_faces_found': total_faces,
@@ -321,13 +1387,17 @@ class FaceMatcher:
         """
         Get face locations along with confidence scores.
         Useful for debugging and showing face detection results.
+        The locations are cached with the encodings, so a cached photo isn't
+        detected again and an uncached one is cached by the same detection pass.
         
         Returns:
             list: List of dictionaries with face location and confidence info
         """
         try:
-            image = self.preprocess_image(image_path)
-            face_locations = face_recognition.face_locations(image, model=self.model)
+            face_locations = self._cached_locations(image_path)
+            if face_locations is None:
+                image = self.preprocess_image(image_path)
+                face_locations = self._detect_faces(image)
             
             faces_info = []
             for i, (top, right, bottom, left) in enumerate(face_locations):
@@ -346,21 +1416,38 @@ class FaceMatcher:
             return faces_info
             
         except Exception as e:
-            print(f"Error getting face locations for {image_path}: {e}")
+            log.warning("Error getting face locations for %s: %s", image_path, e)
             return []
     
+    def _cached_locations(self, image_path):
+        """Face locations of image_path from its cache entry, caching it first; None if unavailable."""
+        mtime = os.path.getmtime(image_path)
+        self.get_face_encodings(image_path, mtime=mtime)
+        entry = self.encodings_cache.get(image_path)
+        if entry is None or entry['timestamp'] < mtime:
+            return None
+        return entry.get('locations')
+    
     def clear_cache(self):
         """Clear the face encodings cache."""
-        self.encodings_cache = {}
-        if os.path.exists(self.cache_file):
-            os.remove(self.cache_file)
-        print("Face encodings cache cleared")
+        with self._cache_lock:
+            self._reset_cache()
+            if self._wal is not None:
+                self._wal.truncate(0)
+                self._write_wal_header()
+            self._wal_records = 0
+            if self._owns_cache:
+                for path in (self.cache_file, self.index_file):
+                    if os.path.exists(path):
+                        os.remove(path)
+            log.info("Face encodings cache cleared")
     
     def get_cache_stats(self):
         """Get statistics about the current cache."""
-        total_encodings = sum(entry.get('face_count', 0) for entry in self.encodings_cache.values())
-        return {
-            'cached_images': len(self.encodings_cache),
-            'total_encodings': total_encodings,
-            'cache_file_exists': os.path.exists(self.cache_file)
-        }
\ No newline at end of file
+        with self._cache_lock:
+            total_encodings = sum(entry.get('face_count', 0) for entry in self.encodings_cache.values())
+            return {
+                'cached_images': len(self.encodings_cache),
+                'total_encodings': total_encodings,
+                'cache_file_exists': bool(self.cache_file) and os.path.exists(self.cache_file)
+            }
\ No newline at end of file